@@ -5,11 +5,24 @@ Created on April 2024
 @author: NCSI (HK)
 """
 
-import datarobot as dr
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List
+
+import altair as alt
+import numpy as np
+import orjson
 import pandas as pd
-import plotly.express as px
+import requests
 import streamlit as st
-import openai
+from diskcache import Cache
+from requests.adapters import HTTPAdapter
 
 
 ## CREDENTIALS
@@ -17,12 +30,89 @@ import openai
 DATAROBOT_API_TOKEN = st.secrets["DR_API"]
 DATAROBOT_ENDPOINT = "https://app.datarobot.com/api/v2"
 DEPLOYMENT_ID = st.secrets["DEPLOYMENT_ID"]
+PREDICTION_URL = (
+    f"{DATAROBOT_ENDPOINT.replace('/api/v2', '')}"
+    f"/predApi/v1.0/deployments/{DEPLOYMENT_ID}/predictions"
+)
+
+# OpenAI, passed per request so the SDK is only imported when an email is generated
+OPENAI_CONFIG = {
+    "api_type": "azure",
+    "api_version": "2024-02-15-preview",
+    "api_base": "https://next-openai-lab.openai.azure.com/",
+    "api_key": st.secrets["openai"]["openai_key"],
+}
+
+# Generated emails are reused for a day
+EMAIL_CACHE_TTL = 24 * 60 * 60
+
+# Number of distinct applications whose predictions are kept in memory
+PREDICTION_CACHE_SIZE = 128
+
+# Seconds a prediction is reused before the deployment is scored again
+PREDICTION_CACHE_TTL = 300
+
+# Seconds to wait for the prediction server, so a hung request fails and is evicted
+PREDICTION_TIMEOUT = 30
+
+## MAPPINGS
+# Form choices to the values the model was trained on
+MAP_EMP_LENGTH = {
+    "0 - 5 years": 0,
+    "6 - 10 years": 6,
+    "11+ years": 10,
+}
+
+MAP_ANNUAL_INC = {
+    "Below 30k": 15_000,
+    "Between 30k and 60k": 40_000,
+    "Above 60k": 100_000,
+}
+
+# Feature names as shown in the explanation chart
+MAP_FEAT_NAME = {
+    "loan_amnt": "Loan Amount",
+    "term": "Repayment Period",
+    "emp_length": "Year of Employment",
+    "annual_inc": "Annual Income",
+}
 
-# OpenAI
-openai.api_type = "azure"
-openai.api_version = "2024-02-15-preview"
-openai.api_base = "https://next-openai-lab.openai.azure.com/"
-openai.api_key = st.secrets["openai"]["openai_key"]
+# Feature names spelled out for the email prompt, replaced in a single pass
+MAP_PROMPT_FEAT_NAME = {
+    "loan_amnt": "loan amount in dollars",
+    "emp_length": "employment tenure in years",
+    "term": "number of months the loan is asked for",
+    "annual_inc": "annual income in dollars",
+}
+PROMPT_FEAT_NAME_RE = re.compile("|".join(map(re.escape, MAP_PROMPT_FEAT_NAME)))
+
+## PROMPTS
+# Dedented once here, only the applicant and explanations are filled in per email
+SYS_PMT = """\
+    You are tasked with generate an email regarding a loan application. \
+    Follow the user defined email format as required.
+    """.strip().replace("    ", "")
+
+USR_PMT_TMPL = """\
+    Below is the top three features that you are going to REJECT the application. \
+    You should not mention the exact values of each feature, \
+    and need to recommend that is the possible way to increase the chance of loan application in the future.
+    
+    ```{{top three features}}
+    {exp_str}
+    ```
+    
+    You are required to use the below email format.
+    
+    ```{{email format}}
+    Dear {client},
+    <content>
+    <state the reason of not approving the loan application>
+    <the reason should be listed in point form.>
+    Your Sincerely,
+    Fictional NCS(I) Finance HK Limited
+    ```
+    """.strip().replace("    ", "")
 
 ## CONFIG
 st.set_page_config(
@@ -31,9 +121,160 @@ st.set_page_config(
     initial_sidebar_state="auto",
 )
 
-@st.cache(allow_output_mutation=True)
-def get_df():
-    return [None]
+# Rerun only the decorated section on interaction where Streamlit supports it
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
+
+@st.cache_resource
+def get_email_cache():
+    # Generated emails, keyed by `email_cache_key`
+    return Cache("./.email_cache")
+
+@st.cache_resource
+def get_prediction_cache():
+    # (submit time, scoring future) shared by all sessions, keyed by the application inputs
+    return OrderedDict(), threading.RLock(), ThreadPoolExecutor(max_workers=8)
+
+
+@st.cache_resource
+def get_session():
+    # Keep-alive connections to the prediction server, reused across reruns
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+    return session
+
+
+## DATAROBOT REAL-TIME PREDICTION
+@dataclass
+class Explanation:
+    feature: str
+    value: str
+    strength: float
+
+
+@dataclass
+class Prediction:
+    # Probability of the positive class, i.e. the risk of default
+    risk: float
+    # Strongest explanation first
+    explanations: List[Explanation]
+
+
+def score_realtime(session, payload, max_explanations=5):
+    """Score records against the deployment's real-time prediction endpoint.
+
+    Returns one `Prediction` per record, parsed straight from the response.
+    """
+    resp = session.post(
+        PREDICTION_URL,
+        params={"maxExplanations": max_explanations},
+        data=orjson.dumps(payload),
+        headers={
+            "Authorization": f"Bearer {DATAROBOT_API_TOKEN}",
+            "Content-Type": "application/json",
+        },
+        timeout=PREDICTION_TIMEOUT,
+    )
+    resp.raise_for_status()
+    
+    return [
+        Prediction(
+            risk=next(
+                pv["value"] for pv in pred["predictionValues"]
+                if str(pv["label"]) == "1"
+            ),
+            explanations=[
+                Explanation(
+                    feature=exp["feature"],
+                    value=str(exp["featureValue"]),
+                    strength=exp["strength"],
+                )
+                for exp in pred.get("predictionExplanations") or []
+            ],
+        )
+        for pred in orjson.loads(resp.content)["data"]
+    ]
+
+
+def submit_prediction(loan_amt, term, emp_length, annual_inc):
+    """Start scoring one application and return its future.
+
+    Identical applications share a single future, so concurrent submissions
+    wait on one in-flight request. Entries are rescored once they are older
+    than `PREDICTION_CACHE_TTL`, and the least recently used entries are
+    evicted past `PREDICTION_CACHE_SIZE`. The resulting list of predictions
+    is shared, do not mutate it.
+    """
+    cache, lock, executor = get_prediction_cache()
+    key = (loan_amt, term, emp_length, annual_inc)
+    
+    def evict_failed(fut):
+        # Do not keep failed requests around, the next submit retries
+        if fut.exception() is not None:
+            with lock:
+                if key in cache and cache[key][1] is fut:
+                    del cache[key]
+    
+    with lock:
+        now = time.monotonic()
+        submitted_at, fut = cache.get(key, (None, None))
+        if fut is None or now - submitted_at > PREDICTION_CACHE_TTL:
+            payload = [{
+                "loan_amnt": loan_amt,
+                "term": term,
+                "emp_length": emp_length,
+                "annual_inc": annual_inc,
+            }]
+            fut = executor.submit(score_realtime, get_session(), payload, max_explanations=5)
+            cache[key] = (now, fut)
+            cache.move_to_end(key)
+            if len(cache) > PREDICTION_CACHE_SIZE:
+                cache.popitem(last=False)
+            fut.add_done_callback(evict_failed)
+        else:
+            cache.move_to_end(key)
+    return fut
+
+
+async def generate_email(sys_pmt, usr_pmt):
+    """Yield the email text as the model generates it."""
+    import openai
+    
+    stream = await openai.ChatCompletion.acreate(
+        messages = [
+            {"role": "system", "content": sys_pmt},
+            {"role": "user", "content": usr_pmt}
+        ],
+        engine="gpt-4o-mini",
+        temperature=.1,
+        top_p=.5,
+        stream=True,
+        **OPENAI_CONFIG,
+    )
+    async for chunk in stream:
+        # Azure emits a leading chunk with no choices (content filter results)
+        if not chunk["choices"]:
+            continue
+        yield chunk["choices"][0]["delta"].get("content") or ""
+
+
+async def stream_email(placeholder, sys_pmt, usr_pmt):
+    """Render the email into `placeholder` while it streams, return the full text."""
+    buf = []
+    async for delta in generate_email(sys_pmt, usr_pmt):
+        buf.append(delta)
+        placeholder.markdown("".join(buf))
+    return "".join(buf)
+
+
+def email_cache_key(client, explanations, decision):
+    """Content hash of the applicant, explanations and decision behind an email.
+
+    The (feature, value) pairs are sorted on purpose: the same explanations
+    in a different order reuse one email, even though the prompt lists them
+    in strength order.
+    """
+    payload = [client, sorted([str(f), str(v)] for f, v in explanations), decision]
+    return hashlib.blake2b(orjson.dumps(payload)).hexdigest()
 
 
 ## TITLE
@@ -50,156 +291,122 @@ with title_icon:
 
 
 ## APPLICATION FORM
-st.subheader("Loan Application Form")
-
-with st.form("loan_form"):
-    client = st.text_input("Applicant Name")
-    loan_amt = st.selectbox("Loan Amount", [5_000, 15_000, 20_000])
-    term = st.selectbox("Repayment Period", [36, 60])
-    emp_length = st.selectbox("Years of Employment", ["0 - 5 years", "6 - 10 years", "11+ years"])
-    annual_inc = st.selectbox("Annual Income", ["Below 30k", "Between 30k and 60k", "Above 60k"])
-    acknowledgement = st.checkbox("Acceptance of Terms and Conditions")
-    
-    sub_application = st.form_submit_button("Submit")
-
-## DATAROBOT PREDICTION
-if sub_application:
-    st.markdown(
-        f"""
-        Your application has been submitted:
-        - Applicant Name: `{client}`
-        - Loan Amount: `{loan_amt}`
-        - Repayment Period: `{term}`
-        - Year of Employment: `{emp_length}`
-        - Annual Income: `{annual_inc}`
-        """
-    )
-    
-    map_emp_length = {
-        "0 - 5 years": 0,
-        "6 - 10 years": 6,
-        "11+ years": 10,
-    }
-    
-    map_annual_inc = {
-        "Below 30k": 15_000,
-        "Between 30k and 60k": 40_000,
-        "Above 60k": 100_000,
-    }
-    
-    scoring_data  = pd.DataFrame({
-        "loan_amnt": [loan_amt],
-        "term": [term],
-        "emp_length": [map_emp_length[emp_length]],
-        "annual_inc": [map_annual_inc[annual_inc]]
-    })
-    
-    dr.Client(
-        token=DATAROBOT_API_TOKEN,
-        endpoint=DATAROBOT_ENDPOINT,
-    )
-    
-    job, df = dr.BatchPredictionJob.score_pandas(
-        DEPLOYMENT_ID,
-        scoring_data,
-        max_explanations=5,
-    )
-    
-    map_feat_name = {
-        "loan_amnt": "Loan Amount",
-        "term": "Repayment Period",
-        "emp_length": "Year of Employment",
-        "annual_inc": "Annual Income",
-    }
-    
-    df_sub = df.copy()
-    df_sub["ex1_fn"] = df_sub["EXPLANATION_1_FEATURE_NAME"].astype(str) + ": " + df_sub["EXPLANATION_1_ACTUAL_VALUE"].astype(str)
-    df_sub["ex2_fn"] = df_sub["EXPLANATION_2_FEATURE_NAME"].astype(str) + ": " + df_sub["EXPLANATION_2_ACTUAL_VALUE"].astype(str)
-    df_sub["ex3_fn"] = df_sub["EXPLANATION_3_FEATURE_NAME"].astype(str) + ": " + df_sub["EXPLANATION_3_ACTUAL_VALUE"].astype(str)
-    df_sub["ex4_fn"] = df_sub["EXPLANATION_4_FEATURE_NAME"].astype(str) + ": " + df_sub["EXPLANATION_4_ACTUAL_VALUE"].astype(str)
-    get_df()[0] = df_sub
+@fragment
+def loan_form_fragment():
+    st.subheader("Loan Application Form")
     
-    st.subheader("Credit Score Explanation")
-    st.write("Risk of default is ", df["is_bad_1_PREDICTION"][0], ", and the explanations are")
-    
-    df_fig = pd.DataFrame({
-        "feature": df_sub.filter(regex="ex\d_fn").iloc[-1].to_list(),
-        "impact" : df_sub.filter(regex="EXPLANATION_\d_STRENGTH").iloc[-1].to_list()
-    })
+    with st.form("loan_form"):
+        client = st.text_input("Applicant Name", key="client")
+        loan_amt = st.selectbox("Loan Amount", [5_000, 15_000, 20_000])
+        term = st.selectbox("Repayment Period", [36, 60])
+        emp_length = st.selectbox("Years of Employment", list(MAP_EMP_LENGTH))
+        annual_inc = st.selectbox("Annual Income", list(MAP_ANNUAL_INC))
+        acknowledgement = st.checkbox("Acceptance of Terms and Conditions")
+        
+        sub_application = st.form_submit_button("Submit")
     
-    fig = px.bar(
-        df_fig,
-        y="feature", x="impact",
-        width=1000, height=600,
-        orientation="h",
-    )
-    st.plotly_chart(fig)
-else:
-    st.write("Fill in the form to proceed the application.")
+    ## DATAROBOT PREDICTION
+    if sub_application:
+        # Score in the background while the summary below is rendered
+        fut = submit_prediction(
+            loan_amt,
+            term,
+            MAP_EMP_LENGTH[emp_length],
+            MAP_ANNUAL_INC[annual_inc],
+        )
+        
+        st.markdown(
+            f"""
+            Your application has been submitted:
+            - Applicant Name: `{client}`
+            - Loan Amount: `{loan_amt}`
+            - Repayment Period: `{term}`
+            - Year of Employment: `{emp_length}`
+            - Annual Income: `{annual_inc}`
+            """
+        )
+        
+        with st.spinner("Evaluating the application..."):
+            pred = fut.result()[0]
+        
+        st.session_state["prediction"] = pred
+        
+        st.subheader("Credit Score Explanation")
+        st.write("Risk of default is ", pred.risk, ", and the explanations are")
+        
+        top_four = pred.explanations[:4]
+        impacts = np.array([exp.strength for exp in top_four], dtype=np.float64)
+        
+        df_fig = pd.DataFrame({
+            "feature": [
+                f"{MAP_FEAT_NAME.get(exp.feature, exp.feature)}: {exp.value}"
+                for exp in top_four
+            ],
+            "impact" : impacts,
+            "color"  : np.where(impacts < 0, "#e74c3c", "#27ae60"),
+        })
+        
+        fig = alt.Chart(df_fig).mark_bar().encode(
+            x="impact:Q",
+            y=alt.Y("feature:N", sort="-x"),
+            color=alt.Color("color:N", scale=None),
+        ).properties(height=600)
+        st.altair_chart(fig, use_container_width=True)
+    else:
+        st.write("Fill in the form to proceed the application.")
 
 
 ## EMAIL GENERATION
-st.subheader("Email Generation")
-
-with st.form("email_form"):
-    approve = st.selectbox(
-        "Are you going to approve the loan application?",
-        ["Approve", "Reject"],
-    )
+@fragment
+def email_fragment():
+    st.subheader("Email Generation")
+    
+    with st.form("email_form"):
+        approve = st.selectbox(
+            "Are you going to approve the loan application?",
+            ["Approve", "Reject"],
+        )
+        
+        sub_email = st.form_submit_button("Generate")
+    
+    ## OPENAI GENERATION
+    if not sub_email:
+        return
+    
+    client = st.session_state.get("client", "")
     
-    sub_email = st.form_submit_button("Generate")
-
-
-## OPENAI GENERATION
-if sub_email:
     if approve == "Approve":
         _ = ""
     elif approve == "Reject":
-        df_sub = get_df()[0]
-        
-        exp_str = f"""\
-        - {df_sub.loc[0, "EXPLANATION_1_FEATURE_NAME"]}: {df_sub.loc[0, "EXPLANATION_1_ACTUAL_VALUE"]}
-        - {df_sub.loc[0, "EXPLANATION_2_FEATURE_NAME"]}: {df_sub.loc[0, "EXPLANATION_2_ACTUAL_VALUE"]}
-        - {df_sub.loc[0, "EXPLANATION_3_FEATURE_NAME"]}: {df_sub.loc[0, "EXPLANATION_3_ACTUAL_VALUE"]}
-        """.replace("loan_amnt", "loan amount in dollars") \
-            .replace("emp_length", "employment tenure in years") \
-            .replace("term", "number of months the loan is asked for") \
-            .replace("annual_inc", "annual income in dollars")
+        pred = st.session_state.get("prediction")
+        if pred is None:
+            st.write("Submit the loan application before generating a rejection email.")
+            return
         
-        sys_pmt = f"""\
-        You are tasked with generate an email regarding a loan application. \
-        Follow the user defined email format as required.
-        """.strip().replace("    ", "")
+        top_three = [(exp.feature, exp.value) for exp in pred.explanations[:3]]
         
-        usr_pmt = f"""\
-        Below is the top three features that you are going to REJECT the application. \
-        You should not mention the exact values of each feature, \
-        and need to recommend that is the possible way to increase the chance of loan application in the future.
+        exp_str = PROMPT_FEAT_NAME_RE.sub(
+            lambda m: MAP_PROMPT_FEAT_NAME[m.group(0)],
+            # Trailing newline keeps the blank line before the closing fence
+            "".join(f"- {feat}: {val}\n" for feat, val in top_three),
+        )
         
-        ```{{top three features}}
-        {exp_str}
-        ```
+        usr_pmt = USR_PMT_TMPL.format(client=client, exp_str=exp_str)
         
-        You are required to use the below email format.
+        placeholder = st.empty()
+        key = email_cache_key(client, top_three, approve)
+        email_cache = get_email_cache()
+        response = email_cache.get(key)
         
-        ```{{email format}}
-        Dear {client},
-        <content>
-        <state the reason of not approving the loan application>
-        <the reason should be listed in point form.>
-        Your Sincerely,
-        Fictional NCS(I) Finance HK Limited
-        ```
-        """.strip().replace("    ", "")
+        if response is None:
+            response = asyncio.run(stream_email(placeholder, SYS_PMT, usr_pmt))
+            # An empty completion (e.g. a content filter stop) is not worth reusing
+            if response:
+                email_cache.set(key, response, expire=EMAIL_CACHE_TTL)
         
-        response = openai.ChatCompletion.create(
-            messages = [
-                {"role": "system", "content": sys_pmt},
-                {"role": "user", "content": usr_pmt}
-            ],
-            engine="gpt-4o-mini",
-            temperature=.1,
-            top_p=.5,
-        )["choices"][0]["message"]["content"]
-        
-        st.write(response)
+        # Swap the streamed markdown for a copyable block once the text is final
+        placeholder.code(response, language=None)
+
+
+loan_form_fragment()
+email_fragment()